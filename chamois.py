@@ -1,13 +1,17 @@
 # Chamois Klipper Plugin
 import threading
+import selectors
 import socket
 import struct
 import time
-from queue import Queue
+from queue import Empty, Queue
 from concurrent.futures import Future
-from typing import NamedTuple
+from functools import partial
+from typing import NamedTuple, Optional
 import logging
 
+_U16 = struct.Struct('<H')
+
 
 class Job(NamedTuple):
     cmd: int
@@ -29,6 +33,16 @@ class Chamois:
 
     _RESPONSE_CODE_OK = 0x00
 
+    _STATUS_RETRY_INTERVAL = 1.0  # seconds between refresh attempts while the cached status is stale
+    _SOCKET_BUFFER_SIZE = 65536  # explicit send/receive buffers, kernel defaults vary on embedded hosts
+
+    # Commands after which the cached status is stale. HALT is handled apart: the MMU restarts, so a status
+    # request pipelined behind it would be lost.
+    _STATUS_CHANGING_CMDS = frozenset((_CMD_HOME, _CMD_DISABLE, _CMD_LOAD, _CMD_UNLOAD, _CMD_SELECT_TOOL))
+
+    # Status payload: <initialized:1><loaded:1><selected_index:1><total_extruded_distance:8><number_of_tool_change:8>
+    _STATUS_FMT = struct.Struct('<BBBQQ')
+
     _CHAMOIS_ON_LOAD = "CHAMOIS_ON_LOAD"
     _CHAMOIS_AFTER_LOAD = "CHAMOIS_AFTER_LOAD"
     _CHAMOIS_ON_UNLOAD = "CHAMOIS_ON_UNLOAD"
@@ -38,26 +52,39 @@ class Chamois:
     def __init__(self, config):
 
         self._running = True
-        self._job_queue: Queue[Job] = Queue()
-        self._thread = threading.Thread(target=self._worker_thread)
-        self._thread.daemon = True
-        self._thread.name = "Chamois MMU Worker Thread"
-        self._thread.start()
-
+        self._job_queue: Queue[Optional[Job]] = Queue()  # None stops the worker
+        self._submit_lock = threading.Lock()  # no job can be queued behind the stop sentinel
+        self._sock = None  # owned by the worker thread
+        self._selector = selectors.DefaultSelector()  # watches self._sock for incoming data
+        self._rx_buf = bytearray()
+        # Wire frames of the payload-less commands never change, build them once
+        self._prebuilt = {code: b'\xAA\x01\x00' + bytes([code]) for code in (
+            self._CMD_PING, self._CMD_GET_STATUS, self._CMD_HOME, self._CMD_DISABLE, self._CMD_HALT,
+            self._CMD_LOAD, self._CMD_UNLOAD, self._CMD_RELEASE)}
         self._initialized = 0
         self._loaded = 0
         self._selected_index = 0
         self._total_extruded_distance = 0
         self._number_of_tool_change = 0
-        self._last_status_update = 0
+        # time.monotonic() of the last status refresh, -inf until the first one
+        self._last_status_update = float('-inf')
+        self._status_dirty = False
 
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
+        self.printer.register_event_handler("klippy:ready", self._handle_ready)
+
+        # Which hook macros are defined, filled in once all config sections are loaded
+        self._has_park = False
+        self._has_before_unload = False
+        self._has_on_unload = False
+        self._has_on_load = False
+        self._has_after_load = False
 
         self.connect_timeout = config.getfloat('connect_timeout', 5.0)  # Default timeout for responses
         self.read_timeout = config.getfloat('read_timeout', 20.0)  # Timeout for command responses
         self.max_retries = config.getint('max_retries', 3)         # Maximum retries for command responses
-        self.mmu_keepalive = config.getint('mmu_keepalive', 10)  # Keep connection alive
+        self.mmu_keepalive = config.getint('mmu_keepalive', 10, minval=1)  # Keep connection alive
 
         self.number_of_toolhead = config.getint('number_of_toolhead', 4, minval=1, maxval=20)
         self.tcp_address = config.get('tcp_address', None)
@@ -66,6 +93,12 @@ class Chamois:
         if not self.tcp_address or not self.tcp_port:
             raise ValueError("TCP address and port must be specified in the configuration.")
 
+        # Started once the configuration is read, the worker uses it
+        self._thread = threading.Thread(target=self._worker_thread)
+        self._thread.daemon = True
+        self._thread.name = "Chamois MMU Worker Thread"
+        self._thread.start()
+
         self.gcode.register_command('CHAMOIS_HOME', self.cmd_CHAMOIS_HOME, desc=self.cmd_CHAMOIS_HOME_help)
         self.gcode.register_command('CHAMOIS_DISABLE', self.cmd_CHAMOIS_DISABLE, desc=self.cmd_CHAMOIS_DISABLE_help)
         self.gcode.register_command('CHAMOIS_HALT', self.cmd_CHAMOIS_HALT, desc=self.cmd_CHAMOIS_HALT_help)
@@ -73,155 +106,236 @@ class Chamois:
 
         # Register T0, T1, ... commands for tool changing
         for i in range(self.number_of_toolhead):
-            self.gcode.register_command(f"T{i}", lambda gcmd, tool=i: self.cmd_CHAMOIS_TOOL_CHANGE(gcmd, tool),
+            self.gcode.register_command(f"T{i}", partial(self.cmd_CHAMOIS_TOOL_CHANGE, index=i),
                                         desc=f"Chamois: Unload, select, load, and release tool {i}")
 
+    def _handle_ready(self):
+        self._refresh_hooks()
+
+    def _refresh_hooks(self):
+        handlers = self.gcode.gcode_handlers
+        self._has_park = self._CHAMOIS_PARK in handlers
+        self._has_before_unload = self._CHAMOIS_BEFORE_UNLOAD in handlers
+        self._has_on_unload = self._CHAMOIS_ON_UNLOAD in handlers
+        self._has_on_load = self._CHAMOIS_ON_LOAD in handlers
+        self._has_after_load = self._CHAMOIS_AFTER_LOAD in handlers
+
     def _worker_thread(self):
-        while self._running:
+        while True:
+            # Sleep until a job arrives or the next status refresh is due. A status received along with
+            # a job counts as a refresh and pushes the next one back, a stale status is retried sooner.
+            interval = self._STATUS_RETRY_INTERVAL if self._status_dirty else self.mmu_keepalive
+            timeout = max(0.0, self._last_status_update + interval - time.monotonic())
             try:
-                cmd, payload, future = self._job_queue.get(timeout=1)
-                logging.info(f"Processing command: {cmd}, payload: {payload}")
-                try:
-                    response_code, response_payload = self._send_and_receive(cmd, payload)
-                    self._update_status(forced=True)
-                    if response_code == self._RESPONSE_CODE_OK:
-                        future.set_result(response_payload)
-                    elif len(response_payload) == 0:
-                        future.set_exception(RuntimeError(f"Command failed with response code: {hex(response_code)}"))
-                    else:
-                        logging.error(
-                            f"Command {cmd} failed with response code: {hex(response_code)} error: {response_payload.decode('utf-8', 'ignore')}")
-                        future.set_exception(RuntimeError(
-                            f"Command failed with response code: {hex(response_code)} error: {payload.decode('utf-8', 'ignore')}"))
-                except Exception as e:
-                    future.set_exception(e)
-            except:
-                continue
-            finally:
+                job = self._job_queue.get(timeout=timeout)
+            except Empty:
                 self._update_status()
+                continue
+            if job is None:
+                break
+            cmd, payload, future = job
+            if not self._running:
+                future.set_exception(InterruptedError("Chamois MMU plugin is shutting down"))
+                continue
+            logging.info("Processing command: %s, payload: %s", cmd, payload)
+            try:
+                if cmd in self._STATUS_CHANGING_CMDS:
+                    self._status_dirty = True
+                if cmd == self._CMD_GET_STATUS:
+                    response_code, response_payload = self._send_and_receive(cmd, payload)
+                    self._update_status(response=(response_code, response_payload))
+                elif self._status_dirty and cmd != self._CMD_HALT:
+                    # Pipeline the status request behind the command, both responses arrive in one round trip.
+                    # The status is best effort: when it is lost the flag stays set and the worker refreshes later.
+                    responses = self._send_and_receive_batch(
+                        ((cmd, payload), (self._CMD_GET_STATUS, b"")), best_effort=1)
+                    response_code, response_payload = responses[0]
+                    if len(responses) > 1:
+                        self._update_status(response=responses[1])
+                else:
+                    response_code, response_payload = self._send_and_receive(cmd, payload)
+                if cmd == self._CMD_HALT:
+                    # Refreshed by the worker in a separate request once the MMU is back
+                    self._status_dirty = True
+
+                if response_code == self._RESPONSE_CODE_OK:
+                    future.set_result(response_payload)
+                elif len(response_payload) == 0:
+                    future.set_exception(RuntimeError(f"Command failed with response code: 0x{response_code:02x}"))
+                else:
+                    error = response_payload.decode('utf-8', 'ignore')
+                    logging.error("Command %s failed with response code: 0x%02x error: %s", cmd, response_code, error)
+                    future.set_exception(RuntimeError(
+                        f"Command failed with response code: 0x{response_code:02x} error: {error}"))
+            except Exception as e:
+                future.set_exception(e)
 
     def _connect(self) -> socket.socket:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._SOCKET_BUFFER_SIZE)
         sock.settimeout(self.connect_timeout)
         sock.connect((self.tcp_address, self.tcp_port))
-        sock.settimeout(1)
+        sock.settimeout(self.read_timeout)
+        self._rx_buf.clear()
         return sock
 
+    def _get_sock(self) -> socket.socket:
+        if self._sock is None:
+            self._sock = self._connect()
+            self._selector.register(self._sock, selectors.EVENT_READ)
+        return self._sock
+
+    def _close_sock(self):
+        if self._sock is not None:
+            self._selector.unregister(self._sock)
+            self._sock.close()
+            self._sock = None
+        self._rx_buf.clear()
+
     def _send_and_receive(self, command_code: int, payload: bytes = b"") -> tuple[int, bytes]:
-        retry_count = 0
-        sock = None
-        while retry_count < self.max_retries:
-            with self._connect() as sock:
-                try:
-                    self._submit_command(sock, command_code, payload)
-                    return self._wait_for_response(sock)
-                except InterruptedError:
-                    raise
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count >= self.max_retries:
-                        raise e
-
-    def _submit_command(self, sock, command_code: int, payload: bytes = b""):
-        length = 1 + len(payload)
-        length_bytes = struct.pack('<H', length)
-        request = bytes([0xAA]) + length_bytes + bytes([command_code]) + payload
-        sock.sendall(request)
+        return self._send_and_receive_batch(((command_code, payload),))[0]
 
-    def _wait_for_response(self, sock: socket.socket) -> tuple[int, bytes]:
-        start_time = time.time()
-        received_bytes = bytearray()
-        while time.time() - start_time < self.read_timeout:
+    def _send_and_receive_batch(self, cmds, best_effort: int = 0) -> list[tuple[int, bytes]]:
+        """Send all (command_code, payload) requests at once, then collect their responses in order
 
+        A request whose response was received is never sent again on retry. The last best_effort requests
+        are not retried, if one of them fails the responses received so far are returned."""
+        frames = [self._encode_request(command_code, payload) for command_code, payload in cmds]
+        responses = []
+        retry_count = 0
+        while True:
             if not self._running:
                 raise InterruptedError("Chamois MMU plugin is shutting down")
+            sock = self._get_sock()
             try:
-                received_bytes.extend(sock.recv(1024))
-            except socket.timeout:
-                continue  # No data received, continue waiting
-
-            # last_byte_time = time.time()
+                sock.sendall(b"".join(frames[len(responses):]))
+                while len(responses) < len(frames):
+                    responses.append(self._wait_for_response(sock))
+                return responses
+            except InterruptedError:
+                raise
+            except Exception as e:
+                # Drop the connection, the next attempt reconnects
+                self._close_sock()
+                if not self._running:
+                    raise InterruptedError("Chamois MMU plugin is shutting down") from e
+                if len(responses) >= len(frames) - best_effort:
+                    logging.error("Chamois MMU request 0x%02x failed: %s", cmds[len(responses)][0], e)
+                    return responses
+                retry_count += 1
+                if retry_count >= self.max_retries:
+                    raise e
+
+    def _encode_request(self, command_code: int, payload: bytes = b"") -> bytes:
+        if not payload and command_code in self._prebuilt:
+            return self._prebuilt[command_code]
+        return b''.join((b'\xAA', _U16.pack(1 + len(payload)), bytes((command_code,)), payload))
 
+    def _wait_for_response(self, sock: socket.socket) -> tuple[int, bytes]:
+        deadline = time.monotonic() + self.read_timeout
+        rx_buf = self._rx_buf
+        while True:
             # Response:  <0xAA:1><length:2><response_code:1><payload>
-            while len(received_bytes) > 0 and received_bytes[0] != 0xAA:
-                received_bytes.pop(0)
-
-            if len(received_bytes) < 4:
-                continue  # minimal response is 4 bytes
-
-            length = int.from_bytes(received_bytes[1:3], 'little')
-
-            if len(received_bytes) < length + 3:
-                continue
-
-            result_code = received_bytes[3]
-            payload = received_bytes[4:4+length-1] if length > 1 else b''
-            return (result_code, payload)
+            # Frames already buffered (e.g. pipelined responses) are parsed before touching the socket.
+            idx = rx_buf.find(b'\xAA')
+            if idx < 0:
+                rx_buf.clear()
+            elif idx > 0:
+                del rx_buf[:idx]
+
+            if len(rx_buf) >= 4:  # minimal response is 4 bytes
+                length = _U16.unpack_from(rx_buf, 1)[0]
+                if len(rx_buf) >= length + 3:
+                    result_code = rx_buf[3]
+                    # Copy the payload straight out of the buffer, the view must be released before resizing it
+                    with memoryview(rx_buf) as view:
+                        payload = bytes(view[4:3+length])
+                    del rx_buf[:3+length]
+                    return (result_code, payload)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._selector.select(timeout=remaining):
+                break
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("Connection closed by Chamois MMU")
+            rx_buf.extend(chunk)
 
         raise TimeoutError(
             "Response timed out after {} seconds".format(self.read_timeout))
 
-    def _update_status(self, forced=False):
+    def _update_status(self, response=None):
+        # response: an already received GET_STATUS response, no request is sent when given
         try:
-            current_time = time.time()
-            if current_time - self._last_status_update < self.mmu_keepalive and not forced:
-                return
+            current_time = time.monotonic()
+            if response is None:
+                if not self._status_dirty and current_time - self._last_status_update < self.mmu_keepalive:
+                    return
+                # Also set on failure, so an unreachable MMU is not retried in a tight loop
+                self._last_status_update = current_time
+                response = self._send_and_receive(self._CMD_GET_STATUS)
 
-            response_code, payload = self._send_and_receive(self._CMD_GET_STATUS)
+            response_code, payload = response
 
             if response_code != self._RESPONSE_CODE_OK:
                 raise RuntimeError(
-                    "Failed to get status from Chamois MMU, response code: {}".format(hex(response_code)))
-
-            self._initialized = bool(payload[0])
-            self._loaded = bool(payload[1])
-            self._selected_index = payload[2]
-            self._total_extruded_distance = int.from_bytes(payload[3:11], 'little')
-            self._number_of_tool_change = int.from_bytes(payload[11:19], 'little')
+                    "Failed to get status from Chamois MMU, response code: 0x{:02x}".format(response_code))
+
+            initialized, loaded, selected_index, total_extruded_distance, number_of_tool_change = \
+                self._STATUS_FMT.unpack_from(payload)
+            self._initialized = bool(initialized)
+            self._loaded = bool(loaded)
+            self._selected_index = selected_index
+            self._total_extruded_distance = total_extruded_distance
+            self._number_of_tool_change = number_of_tool_change
             self._last_status_update = current_time
+            self._status_dirty = False
         except Exception as e:
-            print(f"Error updating Chamois MMU status: {str(e)}")
+            logging.error("Error updating Chamois MMU status: %s", e)
 
     def send_cmd_async(self, cmd, payload=b''):
         future = Future()
-        self._job_queue.put((cmd, payload, future))
+        with self._submit_lock:
+            if self._running:
+                self._job_queue.put((cmd, payload, future))
+                return future
+        future.set_exception(InterruptedError("Chamois MMU plugin is shutting down"))
         return future
 
     def send_cmd(self, cmd, payload=b''):
-        future = self.send_cmd_async(cmd, payload)
-        while not future.done():
-            time.sleep(0.1)
-
-        if future.exception():
-            raise future.exception()
+        return self.send_cmd_async(cmd, payload).result()
+
+    def _wait_with_hook(self, future: Future, hook: str, has_hook: bool):
+        # Keep running the hook macro while the MMU is busy, otherwise block until the command completes
+        if has_hook:
+            run_script = self.gcode.run_script_from_command
+            wait_moves = self.printer.lookup_object('toolhead').wait_moves
+            while not future.done():
+                run_script(hook)
+                wait_moves()
         return future.result()
 
     def _wait_moves(self):
         self.printer.lookup_object('toolhead').wait_moves()
 
     def _park(self):
-        if self._CHAMOIS_PARK in self.gcode.gcode_handlers:
+        if self._has_park:
             self.gcode.run_script_from_command(self._CHAMOIS_PARK)
             self._wait_moves()
 
     def _unload(self):
-        if self._CHAMOIS_BEFORE_UNLOAD in self.gcode.gcode_handlers:
+        if self._has_before_unload:
             self.gcode.run_script_from_command(self._CHAMOIS_BEFORE_UNLOAD)
             self._wait_moves()
 
         unload_future = self.send_cmd_async(self._CMD_UNLOAD)
-        while not unload_future.done():
-            if self._CHAMOIS_ON_UNLOAD in self.gcode.gcode_handlers:
-                self.gcode.run_script_from_command(self._CHAMOIS_ON_UNLOAD)
-                self._wait_moves()
-            else:
-                time.sleep(0.1)
-
-        if unload_future.exception():
-            raise unload_future.exception()
+        self._wait_with_hook(unload_future, self._CHAMOIS_ON_UNLOAD, self._has_on_unload)
 
     def _perform_on_load(self):
-        if self._CHAMOIS_ON_LOAD in self.gcode.gcode_handlers:
+        if self._has_on_load:
             self.gcode.run_script_from_command(self._CHAMOIS_ON_LOAD)
             self._wait_moves()
 
@@ -235,8 +349,19 @@ class Chamois:
         }
 
     def shutdown(self):
-        self._running = False
+        with self._submit_lock:
+            self._running = False
+            self._job_queue.put(None)
+        sock = self._sock
+        if sock is not None:
+            # Unblock a worker waiting for a response
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         self._thread.join()
+        self._close_sock()
+        self._selector.close()
 
     #fmt: off
     cmd_CHAMOIS_HOME_help = "Initializes and homes the Chamois MMU"
@@ -261,7 +386,7 @@ class Chamois:
     def cmd_CHAMOIS_DISABLE(self, gcmd):
         try:
             gcmd.respond_info("Disabling Chamois MMU")
-            self.send_cmd(self._CMD_PING)
+            self.send_cmd(self._CMD_GET_STATUS)
             if self._loaded:
                 self._park()
                 self._unload()
@@ -272,7 +397,7 @@ class Chamois:
 
     cmd_CHAMOIS_STATUS_help = "Returns the current status of the Chamois MMU"
     def cmd_CHAMOIS_STATUS(self, gcmd):
-        self.send_cmd(self._CMD_PING)
+        self.send_cmd(self._CMD_GET_STATUS)
         gcmd.respond_info(f"Chamois MMU status: {self.get_status(None)}")
 
     #fmt: on
@@ -283,7 +408,7 @@ class Chamois:
 
         try:
             gcmd.respond_info("Chamois MMU Tool Change")
-            self.send_cmd(self._CMD_PING)
+            self.send_cmd(self._CMD_GET_STATUS)
 
             if not self._initialized:
                 self.send_cmd(self._CMD_HOME)
@@ -295,18 +420,14 @@ class Chamois:
             if self._loaded:
                 self._unload()
 
-            self.send_cmd(self._CMD_SELECT_TOOL, struct.pack('<H', index))
+            self.send_cmd(self._CMD_SELECT_TOOL, _U16.pack(index))
             load_future = self.send_cmd_async(self._CMD_LOAD)
-            while not load_future.done():
-                self._perform_on_load()
+            self._wait_with_hook(load_future, self._CHAMOIS_ON_LOAD, self._has_on_load)
             self._perform_on_load()
 
-            if load_future.exception():
-                raise load_future.exception()
-
             self.send_cmd(self._CMD_RELEASE)
 
-            if self._CHAMOIS_AFTER_LOAD in self.gcode.gcode_handlers:
+            if self._has_after_load:
                 self.gcode.run_script_from_command(self._CHAMOIS_AFTER_LOAD)
                 self._wait_moves()
             gcmd.respond_info(f"Tool change to index {index} completed successfully.")